@@ -19,11 +19,57 @@ class _CenteredKernelAlignment(Module):
             Y = Y.cpu()
 
         assert X.shape[0] == Y.shape[0], f"Shapes {X.shape} and {Y.shape} do not match"
-        X, Y = X.view(X.shape[0], -1), Y.view(Y.shape[0], -1)
+        # reshape, not view -- activations may be channels_last
+        X, Y = X.reshape(X.shape[0], -1).float(), Y.reshape(Y.shape[0], -1).float()
+        # gram entries / norms over thousands of features overflow in half precision, so keep the loss in fp32 under amp
+        with ch.cuda.amp.autocast(enabled=False):
+            #return ch.log(self.start - CKA(X, Y))
+            return self.fnc(self.similarity(X, Y))
+
+    def similarity(self, X: Tensor, Y: Tensor) -> Tensor:
         X = X - X.mean(dim=0)
         Y = Y - Y.mean(dim=0)
-        #return ch.log(self.start - CKA(X, Y))
-        return self.fnc(CKA(X, Y))
+        return CKA(X, Y)
+
+class _UnbiasedCenteredKernelAlignment(_CenteredKernelAlignment):
+    """
+    CKA from the unbiased HSIC_1 estimator, which doesn't depend on the batch size the way the
+    biased estimator does. Detached sums of the three HSIC terms are kept across batches so
+    an epoch level CKA (ratio of accumulated terms) can be logged; call reset() to clear them.
+    """
+    def __init__(self, fnc, name, device='gpu'):
+        super(_UnbiasedCenteredKernelAlignment, self).__init__(fnc=fnc, name=name, device=device)
+        # running (hsic_xy, hsic_xx, hsic_yy). a plain attribute, not a buffer -- DDP broadcasts buffers
+        # from rank 0 on every forward, which would overwrite each rank's own sums.
+        self.hsic_terms = None
+        # how many batches went into hsic_terms, so an epoch without neural batches isn't read as zero sums
+        self.n_accumulated = 0
+
+    def similarity(self, X: Tensor, Y: Tensor) -> Tensor:
+        assert X.shape[0] > 3, f"HSIC_1 requires more than 3 stimuli, got {X.shape[0]}"
+        K = ch.matmul(X, X.t())
+        L = ch.matmul(Y, Y.t())
+        hsic_xy, hsic_xx, hsic_yy = HSIC1(K, L), HSIC1(K, K), HSIC1(L, L)
+
+        terms = ch.stack([hsic_xy, hsic_xx, hsic_yy]).detach()
+        self.hsic_terms = terms if self.hsic_terms is None else self.hsic_terms + terms
+        self.n_accumulated += 1
+
+        return hsic_xy / ch.sqrt(hsic_xx*hsic_yy)
+
+    def accumulated_terms(self, device=None) -> Tensor:
+        if self.hsic_terms is None:
+            return ch.zeros(3, device=device)
+        return self.hsic_terms.to(device) if device is not None else self.hsic_terms
+
+    def accumulated_similarity(self, terms=None) -> Tensor:
+        """CKA from accumulated (hsic_xy, hsic_xx, hsic_yy), ie summed over processes. defaults to the local sums."""
+        hsic_xy, hsic_xx, hsic_yy = self.accumulated_terms() if terms is None else terms
+        return hsic_xy / ch.sqrt(hsic_xx*hsic_yy)
+
+    def reset(self):
+        self.hsic_terms = None
+        self.n_accumulated = 0
 
 def LogCenteredKernelAlignment():
     def fnc(X):
@@ -45,17 +91,49 @@ def FlipCenteredKernelAlignment():
         return X
     return _CenteredKernelAlignment(fnc=fnc, name='flipCKA')
 
+def UnbiasedLogCenteredKernelAlignment():
+    def fnc(X):
+        return ch.log(1 - X)
+    return _UnbiasedCenteredKernelAlignment(fnc=fnc, name='logCKA_unbiased')
+
+def UnbiasedCenteredKernelAlignment():
+    def fnc(X):
+        return 1 - X
+    return _UnbiasedCenteredKernelAlignment(fnc=fnc, name='CKA_unbiased')
+
 def LogCenteredKernelAlignment0():
     def fnc(X):
         return - ch.log(X)
     return _CenteredKernelAlignment(fnc=fnc, name='logCKA0')
 
 def CKA(X: Tensor, Y: Tensor) -> Tensor:
+    """
+    linear CKA on column centered X, Y. ||Y^T X||_F^2 == <XX^T, YY^T>_F, so when there are
+    fewer stimuli than features (ie IT activations) use the n x n gram matrices instead
+    of the d x d feature covariances.
+    """
+    if X.shape[0] < max(X.shape[1], Y.shape[1]):
+        return gram_CKA(X, Y)
     return frobdot(X,Y)**2 / (frobdot(X,X)*frobdot(Y,Y))
 
+def gram_CKA(X: Tensor, Y: Tensor) -> Tensor:
+    K = ch.matmul(X, X.t())
+    L = ch.matmul(Y, Y.t())
+    return ch.sum(K*L) / (ch.norm(K, p='fro')*ch.norm(L, p='fro'))
+
 def frobdot(X: Tensor, Y: Tensor) -> Tensor:
     return ch.norm(ch.matmul(Y.t(), X), p='fro')
 
+def HSIC1(K: Tensor, L: Tensor) -> Tensor:
+    """unbiased HSIC estimator (Song et al. 2012) on n x n gram matrices K, L"""
+    n = K.shape[0]
+    K = K - ch.diag(ch.diag(K))
+    L = L - ch.diag(ch.diag(L))
+    KL = ch.matmul(K, L)
+    return (
+        ch.trace(KL) + K.sum()*L.sum()/((n - 1)*(n - 2)) - 2*KL.sum()/(n - 2)
+    ) / (n*(n - 3))
+
 # alternate implementation:
 class LogCenteredKernelAlignment2(Module):
 
@@ -134,5 +212,7 @@ NEURAL_LOSSES = {
     'flipCKA' : FlipCenteredKernelAlignment,
     'logCKA' : LogCenteredKernelAlignment,
     'fliplogCKA' : FlipLogCenteredKernelAlignment,
-    'logCKA0' : LogCenteredKernelAlignment0
+    'logCKA0' : LogCenteredKernelAlignment0,
+    'CKA_unbiased' : UnbiasedCenteredKernelAlignment,
+    'logCKA_unbiased' : UnbiasedLogCenteredKernelAlignment
 }
@@ -15,6 +15,7 @@ default_save_path = "dev"
 
 def main(hparams):
     deterministic = seed(hparams)    
+    set_tf32(hparams)
     logger = set_logger(hparams)
 
     dm = { 
@@ -38,16 +39,19 @@ def main(hparams):
         devices=hparams.gpus,   
         accelerator='gpu',
         max_epochs=hparams.epochs,   
+        accumulate_grad_batches=hparams.accumulate_grad_batches,
         check_val_every_n_epoch=hparams.val_every,
         limit_val_batches=hparams.val_batches,
         checkpoint_callback=ckpt_callback,
         num_nodes=hparams.num_nodes,
         logger=logger, callbacks=[lr_monitor],  #   PrintingCallback()],
         deterministic=deterministic,
+        # autotuning can pick a different algorithm each run, so seeded (deterministic) runs keep it off
+        benchmark=bool(hparams.cudnn_benchmark) and not deterministic,
         multiple_trainloader_mode='min_size',
         profiler="simple",
         log_gpu_memory=True,
-        precision=16
+        precision=get_precision(hparams)
     ) 
     
     if hparams.evaluate:
@@ -64,6 +68,24 @@ def seed(hparams):
 
     return deterministic
 
+def set_tf32(hparams):
+    # tf32 tensor cores for fp32 matmuls / convs (ie the fp32 CKA loss). only has an effect on Ampere or newer.
+    ch.backends.cuda.matmul.allow_tf32 = bool(hparams.tf32)
+    ch.backends.cudnn.allow_tf32 = bool(hparams.tf32)
+    # only in torch >= 1.12; the allow_tf32 flags above already cover older versions (ie the pinned 1.8.1)
+    if hasattr(ch, 'set_float32_matmul_precision'):
+        ch.set_float32_matmul_precision('high' if hparams.tf32 else 'highest')
+
+def get_precision(hparams):
+    # bf16 keeps the fp32 exponent range, so lightning skips the GradScaler. needs Ampere or newer.
+    if hparams.precision == 'bf16':
+        # lightning only accepts bf16 with torch >= 1.10, which is when ch.autocast was added
+        if not hasattr(ch, 'autocast'):
+            print(f'precision bf16 requires torch >= 1.10 (found {ch.__version__}), falling back to 16')
+            return 16
+        return hparams.precision
+    return int(hparams.precision)
+
 def set_logger(hparams):
     logger = TensorBoardLogger(
         hparams.log_save_path, name=hparams.file_name, 
@@ -93,6 +115,14 @@ def get_args(*args):
                                help='how many nodes')
     parent_parser.add_argument('--gpus', type=int, default=1,
                                help='how many gpus')
+    parent_parser.add_argument('--precision', dest='precision', type=str, default='16', choices=('16', '32', 'bf16'),
+                               help='training precision. 16 => fp16 amp, bf16 => bf16 amp w/o grad scaling (torch >= 1.10, else falls back to 16), 32 => full precision')
+    parent_parser.add_argument('--tf32', dest='tf32', type=int, default=1,
+                               help='if 1, allow tf32 for fp32 matmuls and convolutions')
+    parent_parser.add_argument('--cudnn_benchmark', dest='cudnn_benchmark', type=int, default=1,
+                               help='if 1, let cudnn autotune conv algorithms for the fixed input size. ignored for seeded (deterministic) runs')
+    parent_parser.add_argument('--accumulate_grad_batches', dest='accumulate_grad_batches', type=int, default=1,
+                               help='how many batches to accumulate gradients over. under ddp, lightning skips the all-reduce on accumulation steps')
     parent_parser.add_argument('--distributed-backend', type=str, default='dp', choices=('dp', 'ddp', 'ddp2'),
                                help='supports three options dp, ddp, ddp2')
     parent_parser.add_argument('--save_top_k', dest='save_top_k', type=int, default=1,
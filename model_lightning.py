@@ -1,6 +1,8 @@
 import os, glob, time, gc
 from collections import OrderedDict
 import argparse
+import functools
+import inspect
 
 import psutil
 import numpy as np
@@ -26,12 +28,14 @@ import torchvision.models as torchvision_models
 import models as custom_models 
 
 process = psutil.Process()
-models_dict = {**torchvision_models.__dict__, **custom_models.__dict__}  # Merge two dictionaries
 
-MODEL_NAMES = sorted(
-    name for name in models_dict
-    if name.islower() and not name.startswith("__") and callable(models_dict[name])
-)
+@functools.lru_cache(maxsize=None)
+def get_model_names():
+    # only built when the arg parser needs the choices
+    return sorted(set(
+        name for module in (torchvision_models, custom_models) for name, fnc in vars(module).items()
+        if name.islower() and not name.startswith("__") and callable(fnc)
+    ))
 
 #####
 
@@ -43,6 +47,8 @@ class Model_Lightning(LightningModule):
     # this should not be called BENCHMARKS, to be consistent with brainscore terminology. PARTITION maybe?
     BENCHMARKS=['fneurons.fstimuli', 'fneurons.ustimuli', 'uneurons.fstimuli', 'uneurons.ustimuli']
     LAYER_MAPS=layer_maps
+    # index of each loss in hparams.loss_weights
+    LOSS_WEIGHT_INDS = {'ImageNet' : 0, 'Neural' : 1, 'StimClass' : 2}
 
     def __init__(self, hparams, dm, *args, **kwargs): 
         super().__init__()
@@ -52,10 +58,16 @@ class Model_Lightning(LightningModule):
         self.hparams.update(vars(hparams))
         self.record_time = hparams.record_time
         self.loss_weights = hparams.loss_weights
+        # device side copy, so weighting losses doesn't mix python floats into the graph
+        self.register_buffer('loss_w', ch.tensor(self.loss_weights, dtype=ch.float32), persistent=False)
         
         assert self.hparams.arch in self.LAYER_MAPS
+        # a fused forward shares batchnorm statistics across ImageNet and neural stimuli
+        assert not (hparams.fused_forward and hparams.multi_bn), 'fused_forward is incompatible with multi_bn'
         self.layer_map = self.LAYER_MAPS[hparams.arch]
         self.model = self.get_model(hparams.arch, pretrained=hparams.pretrained, *args, **kwargs)
+        if hparams.channels_last:
+            self.model = self.model.to(memory_format=ch.channels_last)
         self.regions = self.hook_layers()
         self.neural_loss = self.NEURAL_LOSSES[hparams.neural_loss]()
         self.neural_val_loss = self.NEURAL_LOSSES[hparams.neural_val_loss]()
@@ -89,7 +101,13 @@ class Model_Lightning(LightningModule):
             self.model = paste_bns(self.model, bns)
 
     def forward(self, x):
-        return self.model(x)
+        return self.model(self.to_memory_format(x))
+
+    def to_memory_format(self, X):
+        """match inputs to the model's memory format, so convs don't convert on the fly"""
+        if self.hparams.channels_last:
+            return X.contiguous(memory_format=ch.channels_last)
+        return X
 
     def hook_layers(self):
         if self.hparams.verbose: print(f'Hooking regions {self.hparams.regions}')
@@ -105,13 +123,26 @@ class Model_Lightning(LightningModule):
             for id_ in self.layer_map[region].split('.'):
                 layer = getattr(layer, id_)
 
+            # hooks only hold activations inside forward_regions, so classification batches don't keep IT alive
             if f'{region}_temp' in self.layer_map.keys():
-                layer_hooks[region] = Hook(layer, **self.layer_map[f'{region}_temp'])
+                layer_hooks[region] = Hook(layer, capture=False, **self.layer_map[f'{region}_temp'])
             else:
-                layer_hooks[region] = Hook(layer)
+                layer_hooks[region] = Hook(layer, capture=False)
 
         return layer_hooks
 
+    def forward_regions(self, X, region):
+        """single forward pass returning both the model outputs and the hooked region activations"""
+        hook = self.regions[region]
+        hook.capture = True
+        try:
+            Y_hat = self.model(self.to_memory_format(X))
+        finally:
+            hook.capture = False
+
+        # hand the activations off so the hook doesn't extend their lifetime past this step
+        return Y_hat, hook.pop()
+
     def generate_adversaries(self):
         adversaries = {}
         if self.hparams.adv_train_images:
@@ -169,20 +200,16 @@ class Model_Lightning(LightningModule):
     
     def validation_step(self, batch, batch_idx, dataloader_idx=None, mode='val'):
         ## need a proper map here for the dataloader_idx
-        losses = []
+        loss = ch.zeros((), device=self.device)
         if dataloader_idx is None:
             dataloader_idx = 0
 
         if dataloader_idx == 0:
-            losses.append(
-                self.classification(batch, mode)
-            )
+            loss = loss + self.classification(batch, mode)
             if self.hparams.adv_eval_images:
-                losses.append(
-                    self.classification(batch, f'adv_{mode}', adversarial=True)
-                )
+                loss = loss + self.classification(batch, f'adv_{mode}', adversarial=True)
 
-        return sum(losses)
+        return loss
 
     def validation_epoch_end(self, outputs):
         # we do the real neural validation work here
@@ -450,41 +477,68 @@ class Model_Lightning(LightningModule):
     #    return sum(losses)
 
     def loss_weights_map(self, loss_name):
-        mapping = {
-            'ImageNet' : self.loss_weights[0],
-            'Neural' : self.loss_weights[1],
-            'StimClass' : self.loss_weights[2]
-        }
-
-        return mapping[loss_name]
+        return self.loss_w[self.LOSS_WEIGHT_INDS[loss_name]]
 
     def training_step(self, batch, batch_idx):
         if self.hparams.causal:
             return self._training_step_causal(batch, batch_idx)
+        elif self.hparams.fused_forward:
+            return self._training_step_fused(batch, batch_idx)
         else:
             return self._training_step(batch, batch_idx)
 
     def _training_step(self, batch, batch_idx):
-        losses = []
-
-        losses.append(
-            self.loss_weights_map('ImageNet')*self.classification(
+        # batch is keyed by datamodule name, so just check which datasets are present
+        loss = ch.zeros((), device=self.device)
+        if 'ImageNet' in batch:
+            loss = loss + self.loss_weights_map('ImageNet')*self.classification(
                 batch['ImageNet'], 'train'
             )
-        )
-                
+
         # for less than even mix of neural data
-        if ch.rand(1) > self.hparams.mix_rate:
-            return sum(losses)
+        if ('NeuralData' not in batch) or (ch.rand(1) > self.hparams.mix_rate):
+            return loss
 
         neural_loss, stim_class_loss = self.similarity_and_classification(
             batch['NeuralData'], 'IT', 'train', adversarial=self.hparams.adv_train_images
         )
 
-        losses.append(self.loss_weights_map('Neural')*neural_loss)
-        losses.append(self.loss_weights_map('StimClass')*stim_class_loss)
+        loss = loss + self.loss_weights_map('Neural')*neural_loss
+        loss = loss + self.loss_weights_map('StimClass')*stim_class_loss
+
+        return loss
+
+    def _training_step_fused(self, batch, batch_idx):
+        # nothing to fuse unless both datasets are in the batch
+        if not ('ImageNet' in batch and 'NeuralData' in batch):
+            return self._training_step(batch, batch_idx)
+
+        # for less than even mix of neural data
+        if ch.rand(1) > self.hparams.mix_rate:
+            return self.loss_weights_map('ImageNet')*self.classification(
+                batch['ImageNet'], 'train'
+            )
+
+        # run ImageNet and neural stimuli through the model in a single forward pass
+        X_imnet, _, Y_imnet = self.unpack_batch(batch['ImageNet'], flag='classification')
+        X_stim, H, Y_stim = self.unpack_batch(batch['NeuralData'], flag='similarity')
+
+        if self.hparams.adv_train_images:
+            # adversarial attack on labels. requires HVM readouts to be trained.
+            X_stim = self.adversaries['train_class_adversary'].generate(
+                X_stim, Y_stim, F.cross_entropy, output_inds=[1000,1008]
+            )
+
+        n_imnet = X_imnet.shape[0]
+        Y_hat, H_hat = self.forward_regions(ch.cat([X_imnet, X_stim.type_as(X_imnet)]), 'IT')
 
-        return sum(losses)
+        imnet_loss = self.classification_loss(Y_hat[:n_imnet, 0:1000], Y_imnet, 'train', 'ImageNet')
+        neural_loss = self.similarity_loss(H, H_hat[n_imnet:], 'train')
+        stim_class_loss = self.classification_loss(Y_hat[n_imnet:, 1000:1008], Y_stim, 'train', 'Stimuli')
+
+        return self.loss_weights_map('ImageNet')*imnet_loss \
+            + self.loss_weights_map('Neural')*neural_loss \
+            + self.loss_weights_map('StimClass')*stim_class_loss
 
     def _training_step_causal(self, batch, batch_idx):
         # stochastically zero grads for neural similarity. always zero before step 2500, so HVM accuracy is equilabrated
@@ -494,22 +548,21 @@ class Model_Lightning(LightningModule):
             neural_loss_weight = self.loss_weights_map('Neural')
 
 
-        losses = []
-
-        losses.append(
-            self.loss_weights_map('ImageNet')*self.classification(
+        loss = ch.zeros((), device=self.device)
+        if 'ImageNet' in batch:
+            loss = loss + self.loss_weights_map('ImageNet')*self.classification(
                 batch['ImageNet'], 'train'
             )
-        )
 
-        neural_loss, stim_class_loss = self.similarity_and_classification(
-            batch['NeuralData'], 'IT', 'train', adversarial=self.hparams.adv_train_images
-        )
+        if 'NeuralData' in batch:
+            neural_loss, stim_class_loss = self.similarity_and_classification(
+                batch['NeuralData'], 'IT', 'train', adversarial=self.hparams.adv_train_images
+            )
 
-        losses.append(neural_loss_weight*neural_loss)
-        losses.append(self.loss_weights_map('StimClass')*stim_class_loss)
+            loss = loss + neural_loss_weight*neural_loss
+            loss = loss + self.loss_weights_map('StimClass')*stim_class_loss
 
-        return sum(losses)
+        return loss
 
     def unpack_batch(self, batch, flag):
         X, H, Y = None, None, None
@@ -531,8 +584,12 @@ class Model_Lightning(LightningModule):
             else:
                 raise NameError(f'Unexpected batch length {len(batch)}!')
         
+        # loaders pin memory, so copies can overlap with compute. no-op for batches lightning already moved.
+        X, H, Y = [
+            t.to(self.device, non_blocking=True) if t is not None else None for t in (X, H, Y)
+        ]
         if Y is not None:
-            Y = Y.long().cuda()
+            Y = Y.long()
 
         return X, H, Y
 
@@ -545,15 +602,15 @@ class Model_Lightning(LightningModule):
                 X, Y, F.cross_entropy, output_inds=output_inds
             )
 
-        Y_hat = self.model(X)[:, output_inds[0]:output_inds[1]]
+        Y_hat = self.model(self.to_memory_format(X))[:, output_inds[0]:output_inds[1]]
+
+        return self.classification_loss(Y_hat, Y, mode, dataset)
 
+    def classification_loss(self, Y_hat, Y, mode, dataset):
+        """cross entropy and accuracy logging for already computed (and sliced) model outputs"""
         loss = F.cross_entropy(Y_hat, Y)
         acc1, acc5 = self.__accuracy(Y_hat, Y, topk=(1,5))
 
-        # ??
-        if mode == 'train':
-            pass
-
         log = {
             f'{dataset}_{mode}_loss' : loss,
             f'{dataset}_{mode}_acc1' : acc1,
@@ -573,15 +630,23 @@ class Model_Lightning(LightningModule):
                 X, Y, F.cross_entropy, output_inds=[1000,1008]
             )
 
-        _ = self.model(X)
-        H_hat = self.regions[region].output
+        _, H_hat = self.forward_regions(X, region)
+
+        return self.similarity_loss(H, H_hat, mode)
+
+    def similarity_loss(self, H, H_hat, mode):
+        """neural loss and logging for already computed region activations"""
+        if self.hparams.region_pool and (H_hat.dim() == 4):
+            # pooled-feature CKA: C x pool x pool features instead of C x H x W. gradients still flow through the pool.
+            H_hat = F.adaptive_avg_pool2d(H_hat, self.hparams.region_pool)
 
         # this allows to test with a different loss than the train loss.
         neural_loss_fnc = self.neural_loss if mode == 'train' else self.neural_val_loss
         loss = neural_loss_fnc(H, H_hat)
         log = {f'{neural_loss_fnc.name}_{mode}' : loss}
 
-        self.log_dict(log, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+        # not synced across processes every step; the unbiased losses are reduced once in on_train_epoch_end
+        self.log_dict(log, on_step=False, on_epoch=True, prog_bar=True, logger=True, sync_dist=False)
 
         return loss
 
@@ -595,42 +660,25 @@ class Model_Lightning(LightningModule):
                 X, Y, F.cross_entropy, output_inds=[1000,1008]
             )
 
-        Y_hat = self.model(X)[:, 1000:1008]
-        H_hat = self.regions[region].output
-
-        # this allows to test with a different loss than the train loss.
-        neural_loss_fnc = self.neural_loss if mode == 'train' else self.neural_val_loss
-        neural_loss = neural_loss_fnc(H, H_hat)
+        Y_hat, H_hat = self.forward_regions(X, region)
+        Y_hat = Y_hat[:, 1000:1008]
 
-        # and compute classification loss  accuracy
-        class_loss = F.cross_entropy(Y_hat, Y)
-        acc1, acc5 = self.__accuracy(Y_hat, Y, topk=(1,5))
+        # same loss / pooling / logging as similarity and classification, so every path measures the same features
+        neural_loss = self.similarity_loss(H, H_hat, mode)
+        class_loss = self.classification_loss(Y_hat, Y, mode, dataset)
         # added during a rebuttal period for 1 off experiment -- makes training very slow!
         # EVD90, PR, features = self.__dimension_analysis(H_hat)
 
-        log = {
-            f'{neural_loss_fnc.name}_{mode}' : neural_loss,
-            f'{dataset}_{mode}_loss' : class_loss,
-            f'{dataset}_{mode}_acc1' : acc1,
-            f'{dataset}_{mode}_acc5' : acc5,
-            # f'{dataset}_{mode}_EVD90' : EVD90,
-            # f'{dataset}_{mode}_PR' : PR,
-            # f'{dataset}_{mode}_features' : features
-        }
-
-        self.log_dict(log, on_step=False, on_epoch=True, prog_bar=True, logger=True)
-
         return (neural_loss, class_loss)
 
     def configure_optimizers(self):
-        param_list, lr = self.parameters(), self.hparams.lr
-        
         optimizer = optim.SGD(
-            param_list, 
-            lr = lr, 
+            self.parameters(), 
+            lr = self.hparams.lr, 
             weight_decay=self.hparams.weight_decay, 
             momentum=0.9, 
-            nesterov=True
+            nesterov=True,
+            **self.sgd_kernel_kwargs()
         )
         scheduler = {
             'scheduler' : lr_scheduler.StepLR(
@@ -641,7 +689,40 @@ class Model_Lightning(LightningModule):
 
         return [optimizer], [scheduler]
 
+    @staticmethod
+    def sgd_kernel_kwargs():
+        """
+        fused kernel for the whole parameter list on gpu, multi-tensor (foreach) updates otherwise.
+        only passes what the installed SGD accepts -- older torch (ie the pinned 1.8.1) has neither.
+        """
+        params = inspect.signature(optim.SGD).parameters
+        if ('fused' in params) and ch.cuda.is_available():
+            return {'fused' : True}
+        if 'foreach' in params:
+            return {'foreach' : True}
+        return {}
+
+    def on_train_epoch_start(self):
+        # unbiased CKA losses accumulate HSIC terms over the epoch
+        if hasattr(self.neural_loss, 'reset'):
+            self.neural_loss.reset()
+
     def on_train_epoch_end(self):
+        if hasattr(self.neural_loss, 'accumulated_similarity'):
+            # a single reduction of the accumulated HSIC terms (and batch count) per epoch, rather than syncing the loss every step
+            terms = ch.cat([
+                self.neural_loss.accumulated_terms(self.device),
+                ch.tensor([self.neural_loss.n_accumulated], dtype=ch.float32, device=self.device)
+            ])
+            terms = self.all_gather(terms).reshape(-1, 4).sum(dim=0)
+
+            # no neural batches reached the loss on any process (ie -d ImageNet), so there's no CKA to log
+            if terms[3] > 0:
+                self.log(
+                    f'{self.neural_loss.name}_train_epoch_similarity', self.neural_loss.accumulated_similarity(terms[:3]),
+                    on_step=False, on_epoch=True, prog_bar=True, logger=True, sync_dist=False
+                )
+
         # better memory management
         gc.collect()
 
@@ -653,8 +734,10 @@ class Model_Lightning(LightningModule):
             pred = pred.t()
             correct = pred.eq(target.view(1, -1).expand_as(pred))
             total = output.shape[0]
-            res = [correct[:k].sum().item()/total for k in topk]
-            return res
+            # one tensor for all k, no host syncs. lightning reduces logged tensors at epoch end.
+            cum_correct = correct.float().sum(dim=1).cumsum(dim=0)
+            res = cum_correct[[k - 1 for k in topk]] / total
+            return res.unbind()
 
     @staticmethod
     def __dimension_analysis(X):
@@ -669,7 +752,8 @@ class Model_Lightning(LightningModule):
         def dict_remove_none(kwargs):
             return {k: v for k, v in kwargs.items() if v is not None}
 
-        model_arch = models_dict[arch]
+        # custom models take precedence over torchvision models of the same name
+        model_arch = getattr(custom_models, arch, None) or getattr(torchvision_models, arch)
         # remove kwargs for torchvision_models
         kwargs = dict_remove_none(kwargs) if arch in custom_models.__dict__ else {} 
         print(f'Using pretrained model: {pretrained}')
@@ -682,8 +766,8 @@ class Model_Lightning(LightningModule):
     def add_model_specific_args(cls, parent_parser):  
         parser = argparse.ArgumentParser(parents=[parent_parser])
         parser.add_argument('--v_num', type=int)
-        parser.add_argument('-a', '--arch', metavar='ARCH', choices=MODEL_NAMES, default = 'cornet_s', 
-                            help='model architecture: ' + ' | '.join(MODEL_NAMES))
+        parser.add_argument('-a', '--arch', metavar='ARCH', choices=get_model_names(), default = 'cornet_s', 
+                            help='model architecture: ' + ' | '.join(get_model_names()))
         parser.add_argument('--regions', choices=['V1', 'V2', 'V4', 'IT'], nargs="*", default=['IT'], 
                             help='which CORnet layer to match')
         parser.add_argument('--neural_loss', default='logCKA', choices=cls.NEURAL_LOSSES.keys(), type=str)
@@ -708,6 +792,12 @@ class Model_Lightning(LightningModule):
         parser.add_argument('-multi_bn', '--multi_bn', dest='multi_bn', type=int, default=0)
         parser.add_argument('-mix_rate', '--mix_rate', dest='mix_rate', type=float, default=1)
         parser.add_argument('-causal', '--causal', dest='causal', type=int, default=0)
+        parser.add_argument('-fused', '--fused_forward', dest='fused_forward', type=int, default=0,
+                            help='if 1, run ImageNet and neural stimuli through one concatenated forward pass')
+        parser.add_argument('--region_pool', dest='region_pool', type=int, default=0,
+                            help='if > 0, adaptive avg pool region activations to region_pool x region_pool before the neural loss')
+        parser.add_argument('--channels_last', dest='channels_last', type=int, default=0,
+                            help='if 1, use channels_last (NHWC) memory format for the model and inputs')
         parser.add_argument('--record-time', dest='record_time', action='store_true')
         
         return parser
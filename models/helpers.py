@@ -167,7 +167,7 @@ def add_outputs(model, out_name, n_outputs=8, verbose=False):
 # extract intermediate representations
 class Hook():
     """#### DON'T USE THIS WITH MULTIPLE GPUs!! ####"""
-    def __init__(self, module, backward=False, time_steps=1, output_step=1):
+    def __init__(self, module, backward=False, time_steps=1, output_step=1, capture=True):
         if backward==False:
             self.hook = module.register_forward_hook(self.hook_fn)
         else:
@@ -177,6 +177,8 @@ class Hook():
         self.output_step = output_step
         self.counter = 0
         self.output = None
+        # when False, the hook keeps counting timesteps but holds no reference to the output
+        self.capture = capture
 
     def hook_fn(self, module, input, output):
         """
@@ -187,11 +189,17 @@ class Hook():
 		and only the matching output_step will be written to output.
         """
         self.counter += 1
-        if self.counter == self.output_step:
-            self.output = output
+        if (self.counter == self.output_step) and self.capture:
+            # outside of autograd (ie validation), don't hold on to anything but the data
+            self.output = output if ch.is_grad_enabled() else output.detach()
             
         if self.counter == self.time_steps:
             self.counter = 0
 
+    def pop(self):
+        """returns the captured output and drops the hook's reference to it, so it can be freed after use"""
+        output, self.output = self.output, None
+        return output
+
     def close(self):
         self.hook.remove()